@@ -1,90 +1,382 @@
-from flask import Flask, render_template, send_from_directory, jsonify
-import markdown
+from flask import Flask, Response, render_template, send_from_directory, jsonify, request
+from flask.json.provider import JSONProvider
+from functools import lru_cache
+from markupsafe import Markup
+import cmarkgfm
+import gzip
+import hashlib
+import html
+import orjson
 import os
+import re
+import threading
+import unicodedata
 from pathlib import Path
-import json
 import argparse
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
-app = Flask(__name__)
+class OrjsonProvider(JSONProvider):
+    """JSON provider that encodes and decodes with orjson."""
 
-# Global variable to store documentation path
-doc_base_path = None
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Send orjson's bytes as-is rather than round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+# Static files are served by serve_static below, which sets cache headers
+app = Flask(__name__, static_folder=None)
+app.json = OrjsonProvider(app)
+
+# Documentation directory, resolved once at startup
+app.config['DOCS_ROOT'] = os.environ.get('DOC_DIR') or os.path.join(os.getcwd(), 'cloned_repo', 'documentation')
+
+# GitHub-flavored markdown extensions enabled when rendering documentation
+CMARK_EXTENSIONS = ['table', 'autolink', 'strikethrough', 'tasklist']
+
+# Number of production server threads (override with SERVER_THREADS)
+DEFAULT_SERVER_THREADS = 8
+
+# Cache lifetime for static assets requested with a version parameter
+STATIC_MAX_AGE = 31536000
+
+# Cached /api/docs payload, reused only while a watcher keeps it up to date
+_doc_index = {'path': None, 'root_id': None, 'stale': True, 'payload': None}
+_doc_observer = None
+_doc_lock = threading.Lock()
+
+HEADING_RE = re.compile(r'<h([1-6])>(.*?)</h\1>', re.DOTALL)
+ID_COUNT_RE = re.compile(r'^(.*)_([0-9]+)$')
 
 def get_documentation_files(doc_dir):
     """Get list of documentation files with their directories"""
     files = []
-    for root, _, filenames in os.walk(doc_dir):
-        rel_path = os.path.relpath(root, doc_dir)
-        if rel_path == '.':
-            rel_path = ''
-        
-        for filename in filenames:
-            if filename.endswith('.md'):
-                directory = rel_path if rel_path != '.' else '/'
-                files.append({
-                    'name': filename,
-                    'directory': directory,
-                    'path': os.path.join(rel_path, filename)
-                })
+    _collect_documentation_files(str(doc_dir), '', files)
     return files
 
+def _collect_documentation_files(dir_path, rel_path, files):
+    """Append markdown files below dir_path to files, parents before subdirectories.
+    
+    DirEntry objects carry the file type from the directory listing, so no
+    extra stat call is needed per entry.
+    """
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, list symlinked directories but don't follow them
+                    if not entry.is_symlink():
+                        subdirs.append(entry)
+                elif entry.name.endswith('.md'):
+                    files.append({
+                        'name': entry.name,
+                        'directory': rel_path,
+                        'path': f"{rel_path}/{entry.name}" if rel_path else entry.name
+                    })
+    except OSError:
+        return
+
+    for entry in subdirs:
+        sub_rel_path = f"{rel_path}/{entry.name}" if rel_path else entry.name
+        _collect_documentation_files(entry.path, sub_rel_path, files)
+
+def _dir_id(path):
+    """Identify a directory by device and inode, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+class DocIndexInvalidator(FileSystemEventHandler):
+    """Mark the cached documentation index stale when files come or go."""
+
+    def __init__(self, doc_dir):
+        super().__init__()
+        self.doc_dir = os.path.normpath(str(doc_dir))
+
+    def _root_gone(self, event):
+        # The watch ends with the watched directory, so it must be re-scheduled
+        if os.path.normpath(event.src_path) == self.doc_dir:
+            _doc_index['root_id'] = None
+
+    def on_created(self, event):
+        _doc_index['stale'] = True
+
+    def on_deleted(self, event):
+        _doc_index['stale'] = True
+        self._root_gone(event)
+
+    def on_moved(self, event):
+        _doc_index['stale'] = True
+        self._root_gone(event)
+
+def watch_documentation(doc_dir):
+    """Watch the documentation directory so the docs index can be cached.
+    
+    Returns:
+        True if the watcher was started, False otherwise.
+    """
+    global _doc_observer
+    if _doc_observer is not None:
+        _doc_observer.stop()
+        _doc_observer = None
+
+    observer = Observer()
+    observer.daemon = True
+    try:
+        observer.schedule(DocIndexInvalidator(doc_dir), str(doc_dir), recursive=True)
+        observer.start()
+    except OSError as e:
+        print(f"Not watching documentation directory: {e}")
+        return False
+
+    _doc_observer = observer
+    _doc_index.update(path=doc_dir, root_id=_dir_id(doc_dir), stale=True, payload=None)
+    return True
+
+def get_docs_payload():
+    """Get the serialized /api/docs listing, rebuilding it only after changes.
+    
+    Returns:
+        Dict with the JSON 'body' and its 'etag', plus 'gzip' and 'inline'
+        copies of the body that are filled in the first time they are needed.
+    """
+    docs_root = app.config['DOCS_ROOT']
+    watched = _doc_observer is not None and _doc_index['path'] == docs_root
+    if watched:
+        # A deleted, moved or replaced directory is no longer covered by the watch
+        root_id = _dir_id(docs_root)
+        if root_id != _doc_index['root_id']:
+            with _doc_lock:
+                if root_id is None:
+                    watched = False
+                elif _dir_id(docs_root) != _doc_index['root_id']:
+                    watched = watch_documentation(docs_root)
+    if not watched:
+        return _build_docs_payload(docs_root)
+
+    payload = _doc_index['payload']
+    if not _doc_index['stale'] and payload is not None:
+        return payload
+
+    # Rebuild under the lock so concurrent requests never see a half-built index
+    with _doc_lock:
+        if not _doc_index['stale'] and _doc_index['payload'] is not None:
+            return _doc_index['payload']
+        # Clear the flag before walking so changes made meanwhile are not lost
+        _doc_index['stale'] = False
+        payload = _build_docs_payload(docs_root)
+        _doc_index['payload'] = payload
+    return payload
+
+def _build_docs_payload(docs_root):
+    """Serialize the documentation listing for /api/docs."""
+    body = orjson.dumps(get_documentation_files(docs_root))
+    return {
+        'body': body,
+        'etag': hashlib.blake2b(body, digest_size=8).hexdigest(),
+        'gzip': None,
+        'inline': None
+    }
+
+def _slugify(text):
+    """Turn heading text into an anchor id, as python-markdown's toc extension did."""
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    text = re.sub(r'[^\w\s-]', '', text).strip().lower()
+    return re.sub(r'[-\s]+', '-', text)
+
+def add_heading_ids(html_content):
+    """Add unique id attributes to headings so they can be linked to."""
+    seen = set()
+
+    def add_id(match):
+        level, inner = match.groups()
+        slug = _slugify(html.unescape(re.sub(r'<[^>]+>', '', inner)))
+        # Like the toc extension, number duplicates and never emit an empty id
+        while slug in seen or not slug:
+            count = ID_COUNT_RE.match(slug)
+            if count:
+                slug = f"{count.group(1)}_{int(count.group(2)) + 1}"
+            else:
+                slug = f"{slug}_1"
+        seen.add(slug)
+        return f'<h{level} id="{slug}">{inner}</h{level}>'
+
+    return HEADING_RE.sub(add_id, html_content)
+
+@lru_cache(maxsize=512)
+def _render_markdown(full_path, mtime_ns, size):
+    """Convert a markdown file to HTML.
+
+    The modification time and size are only part of the cache key, so an
+    edited file misses the cache and is rendered again.
+    """
+    with open(full_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    # Convert markdown to HTML with cmark-gfm; code blocks keep a
+    # language-* class so highlight.js can colour them in the browser
+    html_content = cmarkgfm.markdown_to_html_with_extensions(
+        content,
+        options=cmarkgfm.Options.CMARK_OPT_UNSAFE,
+        extensions=CMARK_EXTENSIONS
+    )
+    return add_heading_ids(html_content)
+
+def doc_etag(st):
+    """Get the ETag for a documentation file from its stat result."""
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def _error_html(error):
+    """Format a file reading error for display in the viewer."""
+    return f"<p>Error reading file: {str(error)}</p>"
+
+def _read_markdown(full_path, st):
+    """Render a markdown file whose stat result is already known."""
+    try:
+        return _render_markdown(full_path, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        return _error_html(e)
+
 def read_markdown_file(doc_dir, file_path):
     """Read and convert markdown file to HTML."""
     full_path = os.path.join(doc_dir, file_path)
     try:
-        with open(full_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Convert markdown to HTML with code highlighting
-            html = markdown.markdown(
-                content,
-                extensions=['fenced_code', 'codehilite', 'tables', 'toc']
-            )
-            return html
+        st = os.stat(full_path)
     except FileNotFoundError:
         return None
-    except Exception as e:
-        return f"<p>Error reading file: {str(e)}</p>"
+    except OSError as e:
+        return _error_html(e)
+    return _read_markdown(full_path, st)
+
+@app.template_global()
+def static_url(path):
+    """Get a static asset URL whose version changes whenever the file does."""
+    try:
+        version = os.stat(os.path.join(app.root_path, 'static', path)).st_mtime_ns
+    except OSError:
+        return f'/static/{path}'
+    return f'/static/{path}?v={version:x}'
 
 @app.route('/')
 def index():
-    """Serve the main page."""
-    return render_template('index.html')
+    """Serve the main page, with the docs listing inlined to save a request."""
+    payload = get_docs_payload()
+    if payload['inline'] is None:
+        # Escape markup characters so file names cannot close the script tag
+        inline = payload['body'].decode('utf-8')
+        inline = inline.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+        payload['inline'] = Markup(inline)
+    return render_template('index.html', docs_json=payload['inline'])
 
 @app.route('/api/docs')
 def get_docs():
     """Get list of documentation files."""
-    files = get_documentation_files(doc_base_path)
-    return jsonify(files)
+    payload = get_docs_payload()
+    # The gzip body is a different representation, so it gets its own ETag
+    use_gzip = bool(request.accept_encodings['gzip'])
+    etag = f"{payload['etag']}-gz" if use_gzip else payload['etag']
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding'}
+
+    if use_gzip:
+        if payload['gzip'] is None:
+            payload['gzip'] = gzip.compress(payload['body'])
+        response = Response(payload['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(payload['body'], mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/doc/<path:file_path>')
 def get_doc(file_path):
     """Get content of a specific documentation file."""
-    html_content = read_markdown_file(doc_base_path, file_path)
+    # Stat once so the ETag and the rendered content describe the same version
+    full_path = os.path.join(app.config['DOCS_ROOT'], file_path)
+    try:
+        st = os.stat(full_path)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    except OSError as e:
+        return jsonify({'content': _error_html(e)})
+
+    etag = doc_etag(st)
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    html_content = _read_markdown(full_path, st)
     if html_content is None:
         return jsonify({'error': 'File not found'}), 404
-    return jsonify({'content': html_content})
+    response = jsonify({'content': html_content})
+    response.set_etag(etag)
+    return response
 
 @app.route('/static/<path:path>')
 def serve_static(path):
-    """Serve static files."""
+    """Serve static files.
+    
+    Versioned URLs from static_url can be cached for good, because an
+    edited file gets a new URL; others are revalidated by the browser.
+    """
+    if request.args.get('v'):
+        response = send_from_directory('static', path, max_age=STATIC_MAX_AGE)
+        response.cache_control.immutable = True
+        return response
     return send_from_directory('static', path)
 
-def start_server(port=5000, local=False):
-    """Start the documentation server."""
-    global doc_base_path
+def get_server_threads():
+    """Get the number of production server threads from SERVER_THREADS.
+    
+    Returns:
+        Thread count of at least 1, or DEFAULT_SERVER_THREADS if SERVER_THREADS is invalid.
+    """
+    value = os.getenv('SERVER_THREADS')
+    if value is None:
+        return DEFAULT_SERVER_THREADS
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"Invalid SERVER_THREADS value '{value}', using {DEFAULT_SERVER_THREADS}")
+        return DEFAULT_SERVER_THREADS
+
+def start_server(port=5000, local=False, production=None):
+    """Start the documentation server.
+    
+    Documentation is served from DOC_DIR if set, otherwise from
+    cloned_repo/documentation, or documentation when local is True.
+    The production server (waitress) is used when production is True or,
+    if it is not given, when the PROD environment variable is set.
+    """
     if local:
-        doc_base_path = os.path.join(os.getcwd(), 'documentation')
-    else:
-        doc_base_path = os.path.join(os.getcwd(), 'cloned_repo', 'documentation')
+        app.config['DOCS_ROOT'] = os.path.join(os.getcwd(), 'documentation')
+    if production is None:
+        production = bool(os.getenv('PROD'))
     
     print(f"Starting documentation server at http://localhost:{port}")
-    print(f"Serving documentation from: {doc_base_path}")
-    app.run(host='0.0.0.0', port=port)
+    print(f"Serving documentation from: {app.config['DOCS_ROOT']}")
+    watch_documentation(app.config['DOCS_ROOT'])
+    if production:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=port, threads=get_server_threads())
+    else:
+        app.run(host='0.0.0.0', port=port)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start the documentation server')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the server on')
     parser.add_argument('--local', action='store_true', help='Use local documentation folder instead of cloned_repo')
+    parser.add_argument('--prod', action='store_true', default=None, help='Use the multi-threaded production server (waitress)')
     args = parser.parse_args()
     
-    start_server(port=args.port, local=args.local)
+    start_server(port=args.port, local=args.local, production=args.prod)
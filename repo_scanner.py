@@ -1,16 +1,21 @@
 """Repository documentation generator using Google's Gemini AI."""
 
 import os
-import subprocess
+import hashlib
+import json
+import re
 import shutil
-import platform
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Tuple, Optional, Union, List
+from typing import Dict, Tuple, Optional, Union, List
 import git
 import argparse
-import google.generativeai as genai
+import pathspec
 from dotenv import load_dotenv
-from github import Github
 from datetime import datetime
 from urllib.parse import urlparse
 
@@ -21,12 +26,55 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
 
-# Only configure Gemini if API key is available
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-pro')
-else:
-    model = None
+# Owner and repository name from a GitHub URL with any scheme; repository
+# names may contain dots but must not be empty once .git is stripped
+GITHUB_URL_RE = re.compile(
+    r'^[^/:]+://github\.com/([^/?#]+)/(?!\.git(?:[/?#]|$))([^/?#]+?)(?:\.git)?(?:[/?#].*)?$'
+)
+
+# Number of files analyzed concurrently (override with DOC_WORKERS)
+DEFAULT_WORKERS = 16
+
+# Retry settings for rate-limited (HTTP 429) Gemini requests
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+
+# Directories never scanned: generated docs, caches and vendored dependencies.
+# Hidden directories such as .git and .venv are skipped as well.
+SKIP_DIRS = {'documentation', '__pycache__', 'node_modules', 'venv', 'dist', 'build', 'site-packages'}
+
+# Files smaller than this many bytes are documented together in one request
+SMALL_FILE_SIZE = 2048
+BATCH_SIZE = 10
+
+# Source longer than this many characters is truncated before prompting
+MAX_SOURCE_CHARS = 32000
+
+# Results returned by analyze_python_file when no documentation was generated
+NO_API_KEY_ERROR = "Error: Gemini API key not available"
+ANALYSIS_ERROR_PREFIX = "Error analyzing file:"
+
+# File in the documentation directory recording source hashes of documented files
+MANIFEST_NAME = '.manifest.json'
+
+# Gemini model, created on first use so the SDK is only imported when needed
+model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """Get the Gemini model, configuring the SDK on first use.
+    
+    Returns:
+        The Gemini model, or None if the API key is not available.
+    """
+    global model
+    if model is None and GEMINI_API_KEY:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                model = genai.GenerativeModel('gemini-pro')
+    return model
 
 def extract_repo_info(repo_url: str) -> Tuple[Optional[str], Optional[str]]:
     """Extract owner and repository name from GitHub URL.
@@ -37,17 +85,9 @@ def extract_repo_info(repo_url: str) -> Tuple[Optional[str], Optional[str]]:
     Returns:
         Tuple containing owner and repository name, or (None, None) if invalid.
     """
-    try:
-        parts = repo_url.strip('/').split('/')
-        if len(parts) >= 5 and parts[2] == 'github.com':
-            owner = parts[3]
-            repo = parts[4]
-            # Remove .git extension if present
-            if repo.endswith('.git'):
-                repo = repo[:-4]
-            return owner, repo
-    except:
-        pass
+    match = GITHUB_URL_RE.match(repo_url)
+    if match:
+        return match.group(1), match.group(2)
     return None, None
 
 def create_pull_request(repo_path: str, repo_url: str, branch_name: Optional[str] = None) -> bool:
@@ -67,6 +107,9 @@ def create_pull_request(repo_path: str, repo_url: str, branch_name: Optional[str
         return False
 
     try:
+        # PyGithub is only needed for --create-pr runs
+        from github import Github
+
         # Initialize GitHub client
         g = Github(token)
         
@@ -113,8 +156,16 @@ def create_pull_request(repo_path: str, repo_url: str, branch_name: Optional[str
         print(f"Error creating pull request: {str(e)}")
         return False
 
+def _make_writable_and_retry(func, path, _exc) -> None:
+    """Clear the read-only flag on a path and retry the operation that failed.
+    
+    Git marks object files read-only, which stops Windows from deleting them.
+    """
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
 def remove_directory(path: Union[str, Path]) -> bool:
-    """Remove a directory using the appropriate method for the current OS.
+    """Remove a directory, including read-only files such as git objects.
     
     Args:
         path: Directory path to remove.
@@ -122,20 +173,64 @@ def remove_directory(path: Union[str, Path]) -> bool:
     Returns:
         True if directory was removed successfully, False otherwise.
     """
-    if platform.system() == 'Windows':
-        try:
-            subprocess.run(['cmd', '/c', 'rmdir', '/s', '/q', str(path)], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error removing directory using Windows command: {e}")
-            return False
-    else:
-        try:
-            shutil.rmtree(str(path))
-        except Exception as e:
-            print(f"Error removing directory: {e}")
-            return False
+    try:
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(str(path), onexc=_make_writable_and_retry)
+        else:
+            shutil.rmtree(str(path), onerror=_make_writable_and_retry)
+    except Exception as e:
+        print(f"Error removing directory: {e}")
+        return False
     return True
 
+def get_worker_count() -> int:
+    """Get the number of concurrent analysis workers from DOC_WORKERS.
+    
+    Returns:
+        Worker count of at least 1, or DEFAULT_WORKERS if DOC_WORKERS is invalid.
+    """
+    value = os.getenv('DOC_WORKERS')
+    if value is None:
+        return DEFAULT_WORKERS
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"Invalid DOC_WORKERS value '{value}', using {DEFAULT_WORKERS}")
+        return DEFAULT_WORKERS
+
+def generate_content(prompt: str) -> str:
+    """Send a prompt to Gemini, backing off exponentially when rate limited.
+    
+    Args:
+        prompt: Prompt text.
+        
+    Returns:
+        Generated response text.
+    """
+    from google.api_core.exceptions import ResourceExhausted
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            return get_model().generate_content(prompt).text
+        except ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+def read_source(file_path: Union[str, Path]) -> str:
+    """Read a source file for prompting, truncating very large files.
+    
+    Args:
+        file_path: Path to source file.
+        
+    Returns:
+        File contents, with undecodable bytes replaced.
+    """
+    content = Path(file_path).read_bytes().decode('utf-8', 'replace')
+    if len(content) > MAX_SOURCE_CHARS:
+        content = content[:MAX_SOURCE_CHARS] + '\n# ...[truncated]'
+    return content
+
 def analyze_python_file(file_path: Union[str, Path]) -> str:
     """Analyze a Python file and generate documentation using Google's Gemini AI.
     
@@ -146,8 +241,7 @@ def analyze_python_file(file_path: Union[str, Path]) -> str:
         Generated documentation as markdown text.
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = read_source(file_path)
 
         # Generate documentation using Gemini
         prompt = f"""
@@ -163,14 +257,110 @@ def analyze_python_file(file_path: Union[str, Path]) -> str:
         5. Notable design decisions
         """
         
-        if model is None:
-            return "Error: Gemini API key not available"
+        if get_model() is None:
+            return NO_API_KEY_ERROR
         
-        response = model.generate_content(prompt)
-        return response.text
+        return generate_content(prompt)
+
+    except Exception as e:
+        return f"{ANALYSIS_ERROR_PREFIX} {str(e)}"
+
+def _parse_json_response(text: str) -> dict:
+    """Parse a JSON object from a model response, ignoring a markdown code fence.
+    
+    Args:
+        text: Response text.
+        
+    Returns:
+        Parsed JSON object.
+    """
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+        text = text.rsplit('```', 1)[0]
+    result = json.loads(text)
+    if not isinstance(result, dict):
+        raise ValueError("Expected a JSON object")
+    return result
+
+def analyze_python_files(file_paths: List[Union[str, Path]], repo_path: Union[str, Path]) -> Dict[Union[str, Path], str]:
+    """Analyze several Python files with a single Gemini request.
+    
+    Intended for small files, where the per-request overhead dominates.
+    Files missing from the response or given empty documentation, or all
+    files if the response cannot be parsed, are analyzed individually instead.
+    
+    Args:
+        file_paths: Paths to Python files.
+        repo_path: Path to repository root, used to name files in the prompt.
+        
+    Returns:
+        Mapping of each given file path to its generated documentation.
+    """
+    if len(file_paths) <= 1 or get_model() is None:
+        return {file_path: analyze_python_file(file_path) for file_path in file_paths}
+
+    names = {}
+    try:
+        sections = []
+        for file_path in file_paths:
+            name = Path(os.path.relpath(str(file_path), str(repo_path))).as_posix()
+            names[name] = file_path
+            sections.append(f"File `{name}`:\n```python\n{read_source(file_path)}\n```")
+
+        prompt = """
+        Analyze each of the following Python files and generate detailed markdown documentation for each one.
+
+        Include for each file:
+        1. Overview of functionality
+        2. Key components and their purpose
+        3. Usage examples if applicable
+        4. Dependencies and requirements
+        5. Notable design decisions
+
+        Return only a JSON object mapping each file name, exactly as given, to its markdown documentation.
 
+        """ + "\n\n".join(sections)
+
+        documentation = _parse_json_response(generate_content(prompt))
     except Exception as e:
-        return f"Error analyzing file: {str(e)}"
+        print(f"Batch analysis failed, analyzing files individually: {str(e)}")
+        documentation = {}
+
+    results = {}
+    for name, file_path in names.items():
+        analysis = documentation.get(name)
+        if not isinstance(analysis, str) or not analysis.strip():
+            analysis = analyze_python_file(file_path)
+        results[file_path] = analysis
+    for file_path in file_paths:
+        if file_path not in results:
+            results[file_path] = analyze_python_file(file_path)
+    return results
+
+def is_analysis_error(analysis: str) -> bool:
+    """Check whether an analysis result is one of analyze_python_file's error messages.
+    
+    Args:
+        analysis: Result of analyzing a Python file.
+        
+    Returns:
+        True if no documentation was generated, False otherwise.
+    """
+    return analysis == NO_API_KEY_ERROR or analysis.startswith(ANALYSIS_ERROR_PREFIX)
+
+def get_documentation_file_path(python_file_path: Union[str, Path], repo_path: Union[str, Path]) -> Path:
+    """Get the path of the documentation file for a Python file.
+    
+    Args:
+        python_file_path: Path to Python file.
+        repo_path: Path to repository root.
+        
+    Returns:
+        Path of the markdown file mirroring the Python file's location.
+    """
+    relative_path = Path(python_file_path).relative_to(repo_path)
+    return Path(repo_path, 'documentation', relative_path.with_name(f"{relative_path.stem}_docs.md"))
 
 def create_documentation_file(python_file_path: Union[str, Path], repo_path: Union[str, Path], analysis: str) -> bool:
     """Create a documentation markdown file for the analyzed Python file.
@@ -184,28 +374,23 @@ def create_documentation_file(python_file_path: Union[str, Path], repo_path: Uni
         True if documentation was created successfully, False otherwise.
     """
     try:
-        # Get the relative path of the Python file from the repo root
-        relative_path = os.path.relpath(str(python_file_path), str(repo_path))
-        
-        # Create the documentation path with the same structure
-        doc_path = os.path.join(str(repo_path), 'documentation', os.path.dirname(relative_path))
-        doc_file_name = os.path.basename(relative_path).replace('.py', '_docs.md')
-        doc_file_path = os.path.join(doc_path, doc_file_name)
+        doc_file_path = get_documentation_file_path(python_file_path, repo_path)
         
         # Create the directory structure if it doesn't exist
         try:
-            os.makedirs(doc_path, exist_ok=True)
+            doc_file_path.parent.mkdir(parents=True, exist_ok=True)
         except Exception as e:
             print(f"Error creating documentation directory: {str(e)}")
             return False
         
         try:
-            with open(doc_file_path, 'w', encoding='utf-8') as file:
-                file.write(f"# Documentation for `{os.path.basename(python_file_path)}`\n\n")
-                file.write("---\n\n")
-                file.write(analysis)
-                file.write("\n\n---\n*Documentation generated automatically using Google's Gemini AI*")
-            print(f"Created documentation: {os.path.relpath(doc_file_path, str(repo_path))}")
+            doc_file_path.write_text(
+                f"# Documentation for `{Path(python_file_path).name}`\n\n"
+                f"---\n\n{analysis}"
+                "\n\n---\n*Documentation generated automatically using Google's Gemini AI*",
+                encoding='utf-8'
+            )
+            print(f"Created documentation: {doc_file_path.relative_to(repo_path)}")
             return True
         except Exception as e:
             print(f"Error writing documentation file: {str(e)}")
@@ -232,8 +417,8 @@ def clone_repository(repo_url: str, target_dir: Union[str, Path]) -> bool:
             if not remove_directory(target_dir):
                 return False
         
-        # Clone the repository
-        git.Repo.clone_from(repo_url, str(target_dir))
+        # Only the current files are scanned, so skip history and other branches
+        git.Repo.clone_from(repo_url, str(target_dir), depth=1, single_branch=True)
         print(f"Successfully cloned repository to {target_dir}")
         return True
     except git.GitCommandError as e:
@@ -243,6 +428,67 @@ def clone_repository(repo_url: str, target_dir: Union[str, Path]) -> bool:
         print(f"Error: {str(e)}")
         return False
 
+def hash_file(file_path: Union[str, Path]) -> str:
+    """Compute a short BLAKE2b digest of a file's contents.
+    
+    Args:
+        file_path: Path to file.
+        
+    Returns:
+        Hex digest of the file contents.
+    """
+    with open(file_path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def load_manifest(doc_dir: Union[str, Path]) -> dict:
+    """Load the source hash manifest from the documentation directory.
+    
+    Args:
+        doc_dir: Path to documentation directory.
+        
+    Returns:
+        Mapping of relative Python file paths to content hashes.
+    """
+    try:
+        with open(os.path.join(doc_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(doc_dir: Union[str, Path], manifest: dict) -> bool:
+    """Save the source hash manifest to the documentation directory.
+    
+    Args:
+        doc_dir: Path to documentation directory.
+        manifest: Mapping of relative Python file paths to content hashes.
+        
+    Returns:
+        True if the manifest was saved successfully, False otherwise.
+    """
+    try:
+        with open(os.path.join(doc_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        return True
+    except Exception as e:
+        print(f"Error writing documentation manifest: {str(e)}")
+        return False
+
+def load_gitignore(repo_path: Union[str, Path]) -> Optional[pathspec.PathSpec]:
+    """Load the ignore patterns from the repository's root .gitignore.
+    
+    Args:
+        repo_path: Path to repository root.
+        
+    Returns:
+        Compiled patterns, or None if there is no readable .gitignore.
+    """
+    try:
+        with open(os.path.join(repo_path, '.gitignore'), 'r', encoding='utf-8') as f:
+            return pathspec.GitIgnoreSpec.from_lines(f)
+    except (OSError, ValueError):
+        return None
+
 def scan_repository(repo_path: Union[str, Path]) -> None:
     """Scan through all files in the repository and analyze Python files.
     
@@ -254,31 +500,89 @@ def scan_repository(repo_path: Union[str, Path]) -> None:
         print(f"Repository path {repo_path} does not exist")
         return
 
+    max_workers = get_worker_count()
+
     # Create the documentation directory
     doc_dir = repo_path / 'documentation'
     os.makedirs(doc_dir, exist_ok=True)
 
+    ignore_spec = load_gitignore(repo_path)
+    python_files = []
     for root, dirs, files in os.walk(repo_path):
-        # Skip documentation directory itself
-        if 'documentation' in dirs:
-            dirs.remove('documentation')
-        # Skip .git directory
-        if '.git' in dirs:
-            dirs.remove('.git')
-        # Skip __pycache__ directory
-        if '__pycache__' in dirs:
-            dirs.remove('__pycache__')
+        relative_root = os.path.relpath(root, repo_path)
+        relative_root = '' if relative_root == '.' else Path(relative_root).as_posix() + '/'
+
+        # Prune skipped and ignored directories in place so os.walk never enters them
+        dirs[:] = [
+            d for d in dirs
+            if d not in SKIP_DIRS and not d.startswith('.')
+            and not (ignore_spec and ignore_spec.match_file(f"{relative_root}{d}/"))
+        ]
             
         for file in files:
-            file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(file_path, repo_path)
+            relative_path = relative_root + file
+            if ignore_spec and ignore_spec.match_file(relative_path):
+                continue
             print(f"Found file: {relative_path}")
             
-            # If it's a Python file, analyze it
+            # Queue Python files for analysis
             if file.endswith('.py'):
-                print(f"Analyzing Python file: {relative_path}")
-                analysis = analyze_python_file(file_path)
-                create_documentation_file(file_path, repo_path, analysis)
+                python_files.append(os.path.join(root, file))
+
+    # Skip files whose source is unchanged since their documentation was generated
+    previous_manifest = load_manifest(doc_dir)
+    manifest = {}
+    pending = {}
+    for file_path in python_files:
+        relative_path = Path(os.path.relpath(file_path, repo_path)).as_posix()
+        try:
+            file_hash = hash_file(file_path)
+        except OSError as e:
+            # Let analyze_python_file report the error; nothing is recorded for it
+            print(f"Error reading file {relative_path}: {str(e)}")
+            file_hash = None
+        if (file_hash is not None
+                and previous_manifest.get(relative_path) == file_hash
+                and os.path.exists(get_documentation_file_path(file_path, repo_path))):
+            print(f"Skipping unchanged file: {relative_path}")
+            manifest[relative_path] = file_hash
+        else:
+            pending[file_path] = (relative_path, file_hash)
+
+    # Small files are batched into a single request; the rest go one per request
+    small_files = []
+    batches = []
+    for file_path in pending:
+        try:
+            is_small = os.path.getsize(file_path) < SMALL_FILE_SIZE
+        except OSError:
+            # Unreadable files go alone so their error is reported per file
+            is_small = False
+        if is_small:
+            small_files.append(file_path)
+        else:
+            batches.append([file_path])
+    batches.extend(small_files[i:i + BATCH_SIZE] for i in range(0, len(small_files), BATCH_SIZE))
+
+    # Gemini requests are network-bound, so analyze batches concurrently
+    if batches:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for batch in batches:
+                for file_path in batch:
+                    print(f"Analyzing Python file: {pending[file_path][0]}")
+                futures.append(executor.submit(analyze_python_files, batch, repo_path))
+            
+            for future in as_completed(futures):
+                for file_path, analysis in future.result().items():
+                    created = create_documentation_file(file_path, repo_path, analysis)
+                    # Failed analyses are retried on the next run
+                    relative_path, file_hash = pending[file_path]
+                    if created and file_hash is not None and not is_analysis_error(analysis):
+                        manifest[relative_path] = file_hash
+
+    if manifest or previous_manifest:
+        save_manifest(doc_dir, manifest)
 
 def main() -> None:
     """Main entry point for the repository documentation generator."""
@@ -4,8 +4,12 @@ document.addEventListener('DOMContentLoaded', function() {
 
 async function loadDocumentationFiles() {
     try {
-        const response = await fetch('/api/docs');
-        const files = await response.json();
+        // Use the listing inlined in the page when available
+        let files = window.__DOCS__;
+        if (!files) {
+            const response = await fetch('/api/docs');
+            files = await response.json();
+        }
         
         // Group files by directory
         const groupedFiles = groupFilesByDirectory(files);
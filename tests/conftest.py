@@ -0,0 +1,31 @@
+"""Shared pytest configuration for the test suite."""
+
+import os
+import tempfile
+
+import pytest
+
+
+def pytest_configure(config):
+    """Keep temporary test directories on a RAM-backed filesystem if available.
+
+    Uses the directory in PYTEST_TMPFS, or /dev/shm by default, unless
+    --basetemp was given. pytest still creates and cleans up its numbered
+    pytest-of-<user> directories there as usual.
+    """
+    if config.option.basetemp:
+        return
+    tmpfs = os.environ.get('PYTEST_TMPFS', '/dev/shm')
+    if os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK):
+        tempfile.tempdir = tmpfs
+
+
+@pytest.fixture(autouse=True)
+def no_gemini(monkeypatch):
+    """Keep tests off the real Gemini API even if GEMINI_API_KEY is set.
+
+    load_dotenv() reads the key from .env when repo_scanner is imported.
+    Tests that exercise Gemini requests patch repo_scanner.model themselves.
+    """
+    monkeypatch.setattr('repo_scanner.GEMINI_API_KEY', None)
+    monkeypatch.setattr('repo_scanner.model', None)
@@ -1,27 +1,36 @@
 """Unit tests for the documentation server."""
 
 import os
+import gzip
 import pytest
 import json
+import shutil
 from pathlib import Path
-from doc_server import app, get_documentation_files, read_markdown_file
+from unittest.mock import Mock, patch
+from watchdog.events import DirDeletedEvent
+import doc_server
+from doc_server import app, get_documentation_files, read_markdown_file, add_heading_ids
 
-@pytest.fixture
+# Fixture file contents, encoded once
+TEST1_MD = b'# Test 1\nContent 1'
+TEST2_MD = b'# Test 2\nContent 2'
+
+@pytest.fixture(scope="module")
 def client():
-    """Create a test client."""
+    """Create a test client shared by the tests in this module."""
     app.config['TESTING'] = True
     with app.test_client() as client:
         yield client
 
-@pytest.fixture
-def test_docs(tmp_path):
-    """Create a temporary documentation directory."""
-    doc_path = tmp_path / 'documentation'
+@pytest.fixture(scope="session")
+def test_docs(tmp_path_factory):
+    """Create a temporary documentation directory shared by read-only tests."""
+    doc_path = tmp_path_factory.mktemp('docs') / 'documentation'
     doc_path.mkdir()
     
     # Create test files
-    (doc_path / 'test1.md').write_text('# Test 1\nContent 1')
-    (doc_path / 'test2.md').write_text('# Test 2\nContent 2')
+    (doc_path / 'test1.md').write_bytes(TEST1_MD)
+    (doc_path / 'test2.md').write_bytes(TEST2_MD)
     return doc_path
 
 def test_get_documentation_files(test_docs):
@@ -29,9 +38,23 @@ def test_get_documentation_files(test_docs):
     files = get_documentation_files(test_docs)
     
     assert len(files) == 2
-    file_names = [f['name'] for f in files]
-    assert 'test1.md' in file_names
-    assert 'test2.md' in file_names
+    lookup = {(f['name'], f['directory']) for f in files}
+    assert ('test1.md', '') in lookup
+    assert ('test2.md', '') in lookup
+
+def test_get_documentation_files_nested(tmp_path):
+    """Test documentation file listing in subdirectories"""
+    (tmp_path / 'subdir' / 'nested').mkdir(parents=True)
+    (tmp_path / 'subdir' / 'nested' / 'test3.md').write_text('# Test 3')
+    (tmp_path / 'subdir' / 'notes.txt').write_text('not markdown')
+    
+    files = get_documentation_files(tmp_path)
+    assert files == [{
+        'name': 'test3.md',
+        'directory': 'subdir/nested',
+        'path': 'subdir/nested/test3.md'
+    }]
+    assert get_documentation_files(tmp_path / 'missing') == []
 
 def test_read_markdown_file(test_docs):
     """Test markdown file reading"""
@@ -39,28 +62,168 @@ def test_read_markdown_file(test_docs):
     assert '<h1 id="test-1">Test 1</h1>' in content
     assert '<p>Content 1</p>' in content
 
+def test_read_markdown_file_cache_invalidation(tmp_path):
+    """Test that an edited markdown file is rendered again"""
+    doc_file = tmp_path / 'test.md'
+    doc_file.write_text('# Test\nOriginal content')
+    assert '<p>Original content</p>' in read_markdown_file(tmp_path, 'test.md')
+    
+    doc_file.write_text('# Test\nUpdated content')
+    st = doc_file.stat()
+    os.utime(doc_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert '<p>Updated content</p>' in read_markdown_file(tmp_path, 'test.md')
+
+def test_add_heading_ids():
+    """Test heading anchors are slugified and unique"""
+    html = add_heading_ids('<h1>Test 1</h1>\n<h2>A <code>b</code></h2>\n<h1>Test 1</h1>')
+    assert '<h1 id="test-1">Test 1</h1>' in html
+    assert '<h2 id="a-b">A <code>b</code></h2>' in html
+    assert '<h1 id="test-1_1">Test 1</h1>' in html
+    
+    # Headings without any slug characters still get a non-empty id
+    html = add_heading_ids('<h2>!!!</h2>\n<h2>???</h2>')
+    assert '<h2 id="_1">!!!</h2>' in html
+    assert '<h2 id="_2">???</h2>' in html
+
 def test_index_route(client):
     """Test the index route"""
     response = client.get('/')
     assert response.status_code == 200
     assert b'Documentation Viewer' in response.data
 
+def test_index_route_inlines_docs(client, tmp_path, monkeypatch):
+    """Test the index page embeds the docs listing"""
+    (tmp_path / 'test1.md').write_bytes(TEST1_MD)
+    (tmp_path / '<script>.md').write_text('# Tricky name')
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', tmp_path)
+    
+    response = client.get('/')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert 'window.__DOCS__ = [' in page
+    assert '"name":"test1.md"' in page
+    assert '\\u003cscript\\u003e.md' in page
+    assert '<script>.md' not in page
+
 def test_api_docs_route(client, test_docs, monkeypatch):
     """Test the API docs listing route"""
-    monkeypatch.setattr('doc_server.doc_base_path', test_docs)
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', test_docs)
     
     response = client.get('/api/docs')
     assert response.status_code == 200
     
     data = response.get_json()
     assert len(data) == 2
-    file_names = [f['name'] for f in data]
-    assert 'test1.md' in file_names
-    assert 'test2.md' in file_names
+    lookup = {(f['name'], f['directory']) for f in data}
+    assert ('test1.md', '') in lookup
+    assert ('test2.md', '') in lookup
+
+def test_orjson_provider():
+    """Test JSON responses are encoded by orjson"""
+    assert isinstance(app.json, doc_server.OrjsonProvider)
+    with app.app_context():
+        response = app.json.response({'content': '<p>caf\u00e9</p>'})
+    assert response.mimetype == 'application/json'
+    assert response.data == '{"content":"<p>caf\u00e9</p>"}'.encode('utf-8')
+    assert app.json.loads(response.data) == {'content': '<p>caf\u00e9</p>'}
+
+def test_api_docs_route_encoding(client, test_docs, monkeypatch):
+    """Test the docs listing honours gzip and conditional requests"""
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', test_docs)
+    
+    response = client.get('/api/docs', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.data))) == 2
+    gzip_etag = response.headers['ETag']
+    
+    response = client.get('/api/docs')
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['ETag'] != gzip_etag
+    plain_etag = response.headers['ETag']
+    
+    response = client.get('/api/docs', headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == gzip_etag
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    
+    response = client.get('/api/docs', headers={'If-None-Match': plain_etag})
+    assert response.status_code == 304
+    
+    # A validator for one representation does not match the other
+    response = client.get('/api/docs', headers={'If-None-Match': gzip_etag})
+    assert response.status_code == 200
+
+def test_api_docs_route_cached(client, tmp_path, monkeypatch):
+    """Test the docs listing is cached until the watcher reports a change"""
+    (tmp_path / 'test1.md').write_bytes(TEST1_MD)
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', tmp_path)
+    monkeypatch.setattr('doc_server._doc_observer', None)
+    monkeypatch.setattr('doc_server._doc_index', {'path': None, 'root_id': None, 'stale': True, 'payload': None})
+    
+    with patch('doc_server.Observer'):
+        assert doc_server.watch_documentation(tmp_path) is True
+    
+    assert len(client.get('/api/docs').get_json()) == 1
+    
+    # New files are not picked up until the index is invalidated
+    (tmp_path / 'test2.md').write_bytes(TEST2_MD)
+    assert len(client.get('/api/docs').get_json()) == 1
+    
+    doc_server.DocIndexInvalidator(tmp_path).on_created(Mock())
+    assert len(client.get('/api/docs').get_json()) == 2
+
+def test_api_docs_route_index_building(client, tmp_path, monkeypatch):
+    """Test requests arriving while the first index build is in flight"""
+    (tmp_path / 'test1.md').write_bytes(TEST1_MD)
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', tmp_path)
+    monkeypatch.setattr('doc_server._doc_observer', Mock())
+    # Another request has cleared the stale flag but not stored its payload yet
+    monkeypatch.setattr('doc_server._doc_index', {
+        'path': tmp_path, 'root_id': doc_server._dir_id(tmp_path), 'stale': False, 'payload': None
+    })
+
+    response = client.get('/api/docs')
+    assert response.status_code == 200
+    assert len(response.get_json()) == 1
+    assert client.get('/').status_code == 200
+
+def test_api_docs_route_root_recreated(client, tmp_path, monkeypatch):
+    """Test the docs listing follows a documentation directory that is replaced"""
+    doc_path = tmp_path / 'documentation'
+    doc_path.mkdir()
+    (doc_path / 'a.md').write_bytes(TEST1_MD)
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', doc_path)
+    monkeypatch.setattr('doc_server._doc_observer', None)
+    monkeypatch.setattr('doc_server._doc_index', {'path': None, 'root_id': None, 'stale': True, 'payload': None})
+    
+    with patch('doc_server.Observer') as mock_observer:
+        assert doc_server.watch_documentation(doc_path) is True
+        assert [f['name'] for f in client.get('/api/docs').get_json()] == ['a.md']
+        
+        # Moving the directory away sends no event for it, but it is re-watched
+        doc_path.rename(tmp_path / 'old')
+        doc_path.mkdir()
+        (doc_path / 'b.md').write_bytes(TEST2_MD)
+        assert [f['name'] for f in client.get('/api/docs').get_json()] == ['b.md']
+        assert mock_observer.call_count == 2
+        
+        # Deleting the directory ends the watch, even if its inode is reused
+        handler = mock_observer.return_value.schedule.call_args[0][0]
+        shutil.rmtree(doc_path)
+        handler.on_deleted(DirDeletedEvent(str(doc_path)))
+        assert client.get('/api/docs').get_json() == []
+        assert b'window.__DOCS__ = []' in client.get('/').data
+        
+        doc_path.mkdir()
+        (doc_path / 'c.md').write_bytes(TEST1_MD)
+        assert [f['name'] for f in client.get('/api/docs').get_json()] == ['c.md']
+        assert mock_observer.call_count == 3
 
 def test_api_doc_route(client, test_docs, monkeypatch):
     """Test the API doc content route"""
-    monkeypatch.setattr('doc_server.doc_base_path', test_docs)
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', test_docs)
     
     # Test valid file
     response = client.get('/api/doc/test1.md')
@@ -69,11 +232,69 @@ def test_api_doc_route(client, test_docs, monkeypatch):
     assert '<h1 id="test-1">Test 1</h1>' in data['content']
     assert '<p>Content 1</p>' in data['content']
     
+    # The file is stat'ed once per request
+    with patch('doc_server.os.stat', wraps=os.stat) as mock_stat:
+        client.get('/api/doc/test1.md')
+        assert mock_stat.call_count == 1
+    
+    # Test conditional request with matching ETag
+    etag = response.headers['ETag']
+    response = client.get('/api/doc/test1.md', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    
     # Test invalid file
     response = client.get('/api/doc/nonexistent.md')
     assert response.status_code == 404
 
+@pytest.mark.slow
 def test_static_route(client):
     """Test the static file route"""
     response = client.get('/static/js/main.js')
     assert response.status_code == 200
+    assert 'immutable' not in response.headers['Cache-Control']
+    
+    # Versioned URLs used by the index page are cached long-term
+    with app.test_request_context():
+        url = doc_server.static_url('js/main.js')
+    assert '?v=' in url
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.max_age == doc_server.STATIC_MAX_AGE
+    assert response.cache_control.immutable
+    
+    response = client.get('/static/missing.js')
+    assert response.status_code == 404
+
+@patch('doc_server.watch_documentation')
+@patch('doc_server.app.run')
+def test_start_server(mock_run, mock_watch, monkeypatch, tmp_path):
+    """Test server selection in start_server"""
+    monkeypatch.setitem(app.config, 'DOCS_ROOT', str(tmp_path))
+    monkeypatch.delenv('PROD', raising=False)
+    
+    doc_server.start_server(8000)
+    mock_watch.assert_called_once_with(str(tmp_path))
+    mock_run.assert_called_once_with(host='0.0.0.0', port=8000)
+    
+    mock_run.reset_mock()
+    mock_watch.reset_mock()
+    
+    doc_server.start_server(8000, local=True)
+    mock_run.assert_called_once_with(host='0.0.0.0', port=8000)
+    mock_watch.assert_called_once_with(os.path.join(os.getcwd(), 'documentation'))
+    
+    mock_run.reset_mock()
+    monkeypatch.setenv('PROD', '1')
+    monkeypatch.delenv('SERVER_THREADS', raising=False)
+    with patch('waitress.serve') as mock_serve:
+        doc_server.start_server(8000)
+        mock_serve.assert_called_once_with(app, host='0.0.0.0', port=8000, threads=8)
+    mock_run.assert_not_called()
+    
+    # Invalid thread counts are clamped or replaced by the default
+    for value, threads in [('4', 4), ('0', 1), ('many', doc_server.DEFAULT_SERVER_THREADS)]:
+        monkeypatch.setenv('SERVER_THREADS', value)
+        with patch('waitress.serve') as mock_serve:
+            doc_server.start_server(8000)
+            mock_serve.assert_called_once_with(app, host='0.0.0.0', port=8000, threads=threads)